@@ -1,11 +1,25 @@
+import atexit
+import logging
+import operator
 import os
+import orjson
 import requests
+import sqlite3
 import time 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # --- 1. CONFIGURATION AND SECRETS ---
 
+logging.basicConfig(
+    level=logging.INFO,
+    format="[%(asctime)s] %(levelname)s: %(message)s",
+    datefmt="%Y-%m-%dT%H:%M:%S",
+)
+
 TELEGRAM_TOKEN = os.getenv('BOT_TOKEN')
 TELEGRAM_CHAT_ID = os.getenv('CHAT_ID')
+TELEGRAM_SEND_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
 
 # Use a TON API provider that offers specific NFT endpoints. 
 # tonapi.io is used here for demonstration, but you may need a key for higher limits.
@@ -15,37 +29,181 @@ TON_API_BASE_URL = "https://tonapi.io/v2/"
 # Example placeholder for a collection address:
 TARGET_ACCOUNT_ADDRESS = "EQA-Q1R35bYd1Gz0N-r2r_tq7fI-W8-e_r_e_r_e_r" # <<< REPLACE THIS!
 
-# File to store the last processed event ID (we now track an item ID or timestamp)
-STATE_FILE = 'last_checked_timestamp.txt'
+# Fetch recent NFT transfers related to the collection contract.
+# Filtering by account address requires the specific collection address (e.g., Fragment's).
+# We limit to 10 events to ensure we catch recent drops.
+API_ENDPOINT = f"{TON_API_BASE_URL}nft/transfers?account={TARGET_ACCOUNT_ADDRESS}&limit=10"
+
+# SQLite database holding all bot state as key/value pairs:
+# the last processed event timestamp and the TON API's ETag (so unchanged pages come back as 304 Not Modified)
+STATE_DB = 'state.db'
+
+# How many recently alerted transfers to remember, so events sharing the last
+# processed timestamp are neither re-alerted nor skipped
+SEEN_TRANSFERS_LIMIT = 32
+_state_conn = None
+
+# (connect, read) timeouts in seconds for every outgoing request
+REQUEST_TIMEOUT = (3.05, 10)
+
+# One pooled session for the whole run, so repeated calls to tonapi.io and
+# api.telegram.org reuse the same keep-alive connection instead of paying
+# a fresh TCP+TLS handshake each time.
+def _make_adapter(status_forcelist):
+    """Builds a pooled adapter that retries transient failures with backoff."""
+    return HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=status_forcelist,
+            allowed_methods=["GET", "POST"],
+            # Hand the last response back instead of raising, so callers
+            # can inspect its body.
+            raise_on_status=False,
+        ),
+    )
+
+SESSION = requests.Session()
+_adapter = _make_adapter([429, 500, 502, 503, 504])
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+# Telegram throttling is handled by send_alert using the retry_after from the
+# response body, so the adapter must not burn throttled retries of its own.
+SESSION.mount("https://api.telegram.org/", _make_adapter([500, 502, 503, 504]))
+SESSION.headers.update({
+    'User-Agent': 'gift-tracker/1.0',
+    # Ask for canonical UTF-8 JSON so bodies can go straight to orjson.loads
+    'Accept': 'application/json',
+    # 'br' is decoded by urllib3 when the brotli package is installed
+    'Accept-Encoding': 'gzip, br',
+})
+atexit.register(SESSION.close)
+
+# Telegram MarkdownV2 requires these characters to be backslash-escaped
+# wherever they should appear literally.
+_MDV2 = str.maketrans({c: "\\" + c for c in "_*[]()~`>#+-=|{}.!\\"})
+# Inside the (...) part of an inline link only ')' and '\' must be escaped.
+_MDV2_URL = str.maketrans({c: "\\" + c for c in ")\\"})
+
+# Telegram caps a message at 4096 characters; leave some headroom.
+MAX_MESSAGE_LENGTH = 4000
+
+# Minimum spacing between sends, keeping us under Telegram's 30 messages/second.
+SEND_INTERVAL = 1 / 30
+MAX_SEND_ATTEMPTS = 3
+_last_send_time = 0.0
+
+# Alert body in MarkdownV2, with the static parts escaped once here. Only the
+# per-transfer fields are interpolated, in order: item name, time, source,
+# destination and link.
+ALERT_TEMPLATE = (
+    "🎁 *NEW NFT GIFT ALERT\\!* 🎁\n\n"
+    "**Item:** `%s`\n"
+    "**Time:** `%s`\n"
+    "**Source:** `%s...`\n"
+    "**Destination:** `%s...`\n"
+    "**Link:** [View Gift](%s)\n"
+    "_Check the link for full details, price, and marketplace\\._"
+)
 
 
 # --- 2. CORE FUNCTIONS ---
 
+def escape_markdown(text):
+    """Escapes a dynamic value for safe use inside a MarkdownV2 message."""
+    return str(text).translate(_MDV2)
+
+def escape_markdown_url(url):
+    """Escapes a URL for use as the target of a MarkdownV2 inline link."""
+    return str(url).translate(_MDV2_URL)
+
+def _state_db():
+    """Opens the state database on first use and returns the shared connection."""
+    global _state_conn
+    if _state_conn is None:
+        _state_conn = sqlite3.connect(STATE_DB)
+        _state_conn.execute("PRAGMA journal_mode=WAL")
+        _state_conn.execute("PRAGMA synchronous=NORMAL")
+        _state_conn.execute("CREATE TABLE IF NOT EXISTS state(k TEXT PRIMARY KEY, v BLOB)")
+        # Closing the last connection checkpoints the WAL back into state.db
+        atexit.register(_state_conn.close)
+    return _state_conn
+
+def read_state(key):
+    """Reads a value from the state database, or None if it was never written."""
+    row = _state_db().execute("SELECT v FROM state WHERE k = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def write_state(key, value):
+    """Writes a value to the state database."""
+    conn = _state_db()
+    conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, value))
+    conn.commit()
+
 def read_last_timestamp():
-    """Reads the last known processing timestamp from the state file."""
-    if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, 'r') as f:
-            try:
-                # Expecting an integer timestamp (seconds)
-                return int(f.read().strip())
-            except ValueError:
-                return 0
-    return 0
+    """Reads the last known processing timestamp from the state database."""
+    try:
+        # Expecting an integer timestamp (seconds)
+        return int(read_state('last_timestamp'))
+    except (TypeError, ValueError):
+        return 0
 
 def write_last_timestamp(new_timestamp):
-    """Writes the new timestamp to the state file."""
-    with open(STATE_FILE, 'w') as f:
-        f.write(str(new_timestamp))
+    """Writes the new timestamp to the state database."""
+    write_state('last_timestamp', new_timestamp)
+
+def read_last_etag():
+    """Reads the ETag of the last processed TON API response, if any."""
+    return read_state('etag')
+
+def write_last_etag(etag):
+    """Writes the ETag of the processed TON API response to the state database."""
+    write_state('etag', etag)
+
+def transfer_key(transfer):
+    """Identifies an NFT transfer across runs."""
+    return f"{transfer.get('nft_item_address', 'N/A')}:{transfer.get('block_timestamp', 0)}"
+
+def read_seen_transfers():
+    """Reads the keys of recently alerted transfers, oldest first."""
+    value = read_state('seen_transfers')
+    return orjson.loads(value) if value else []
+
+def write_seen_transfers(keys):
+    """Writes the most recent SEEN_TRANSFERS_LIMIT transfer keys to the state database."""
+    write_state('seen_transfers', orjson.dumps(keys[-SEEN_TRANSFERS_LIMIT:]))
+
+def split_message(blocks, limit=MAX_MESSAGE_LENGTH):
+    """Joins alert blocks into as few messages as fit within the length limit."""
+    messages = []
+    current = ''
+    for block in blocks:
+        if current and len(current) + 2 + len(block) > limit:
+            messages.append(current)
+            current = ''
+        current = f"{current}\n\n{block}" if current else block
+    if current:
+        messages.append(current)
+    return messages
+
+def _wait_for_send_slot():
+    """Sleeps just long enough to keep sends SEND_INTERVAL apart."""
+    global _last_send_time
+    delay = _last_send_time + SEND_INTERVAL - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+    _last_send_time = time.monotonic()
 
 def send_alert(message_text):
     """Sends a message to the Telegram chat."""
     
     if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
-        print("Error: Missing Telegram Token or Chat ID.")
+        logging.error("Missing Telegram Token or Chat ID.")
         return
 
     # Using 'MarkdownV2' for rich formatting
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
     payload = {
         'chat_id': TELEGRAM_CHAT_ID,
         'text': message_text,
@@ -53,52 +211,84 @@ def send_alert(message_text):
     }
     
     try:
-        response = requests.post(url, data=payload)
-        response.raise_for_status()
-        print("Alert sent successfully!")
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to send alert: {e}")
+        for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+            _wait_for_send_slot()
+            response = SESSION.post(TELEGRAM_SEND_URL, data=payload, timeout=REQUEST_TIMEOUT)
+            # Telegram reports the outcome in the body's 'ok' field, whatever the HTTP status
+            body = orjson.loads(response.content)
+            if body.get('ok'):
+                logging.info("Alert sent successfully!")
+                return
+
+            retry_after = body.get('parameters', {}).get('retry_after')
+            if not retry_after or attempt == MAX_SEND_ATTEMPTS:
+                break
+            logging.warning("Rate limited by Telegram, retrying in %ss.", retry_after)
+            time.sleep(retry_after + 0.1)
+
+        logging.error(
+            "Failed to send alert: %s %s",
+            body.get('error_code', response.status_code),
+            body.get('description', ''),
+        )
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        logging.error("Failed to send alert: %s", e)
 
 
 def check_for_new_gifts():
     """Fetches NFT transfer events and sends detailed alerts."""
     
     last_timestamp = read_last_timestamp()
-    print(f"Last checked timestamp: {last_timestamp}")
+    logging.info("Last checked timestamp: %s", last_timestamp)
+
+    # Ask for the page only if it changed since the last processed response
+    headers = {}
+    last_etag = read_last_etag()
+    if last_etag:
+        headers['If-None-Match'] = last_etag
 
     try:
-        # Fetch recent NFT transfers related to the collection contract.
-        # Filtering by account address requires the specific collection address (e.g., Fragment's).
-        # We limit to 10 events to ensure we catch recent drops.
-        api_endpoint = f"{TON_API_BASE_URL}nft/transfers?account={TARGET_ACCOUNT_ADDRESS}&limit=10"
-        
-        response = requests.get(api_endpoint)
+        response = SESSION.get(API_ENDPOINT, headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304:
+            logging.info("TON API data not modified since the last check.")
+            return
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         
+    except requests.exceptions.HTTPError as e:
+        # Log the raw bytes so the error path never triggers a charset guess
+        logging.error("Error fetching TON API data: %s - %r", e, e.response.content[:200])
+        return
     except requests.exceptions.RequestException as e:
-        print(f"Error fetching TON API data: {e}")
+        logging.error("Error fetching TON API data: %s", e)
+        return
+    except orjson.JSONDecodeError as e:
+        logging.error("Error parsing TON API response: %s", e)
         return
 
-    new_events_found = False
-    
+    seen_keys = read_seen_transfers()
+    seen = set(seen_keys)
+
+    # Keep only events that were not processed yet, in a single pass. Events at the
+    # last processed timestamp are kept unless they were already alerted.
+    transfers = []
+    for transfer in data.get('nft_transfers', []):
+        key = transfer_key(transfer)
+        if transfer.get('block_timestamp', -1) < last_timestamp or key in seen:
+            continue
+        seen.add(key)
+        transfers.append(transfer)
+    new_events_found = bool(transfers)
+
     # Events are usually returned newest first. We process them oldest first to alert in order.
-    transfers = sorted(data.get('nft_transfers', []), key=lambda x: x['block_timestamp'])
+    # On an already-ordered page this sort is a linear run reversal.
+    transfers.sort(key=operator.itemgetter('block_timestamp'))
 
-    newest_timestamp = last_timestamp
+    newest_timestamp = transfers[-1]['block_timestamp'] if transfers else last_timestamp
+    alerts = []
 
     for transfer in transfers:
-        current_timestamp = transfer.get('block_timestamp', 0)
-        
-        # Skip events that were already processed
-        if current_timestamp <= last_timestamp:
-            continue
-            
-        new_events_found = True
-        
-        # Update the newest timestamp found in this run
-        if current_timestamp > newest_timestamp:
-            newest_timestamp = current_timestamp
+        current_timestamp = transfer['block_timestamp']
 
         # --- 3. EXTRACT RICH DETAILS ---
         
@@ -106,33 +296,38 @@ def check_for_new_gifts():
         nft_item = transfer.get('nft_item', {})
         
         # The NFT name is usually in the metadata (though the API sometimes includes it directly)
-        item_name = nft_item.get('metadata', {}).get('name', 'Collectible Gift')
+        item_name = escape_markdown(nft_item.get('metadata', {}).get('name', 'Collectible Gift'))
         item_address = transfer.get('nft_item_address', 'N/A')
         
         # Format the alert message
         timestamp_readable = time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(current_timestamp))
-        link = f"https://tonscan.org/nft/{item_address}"
+        link = escape_markdown_url(f"https://tonscan.org/nft/{item_address}")
         
-        # MarkdownV2 formatting (special characters like '-' and '.' need to be escaped)
-        message = (
-            f"🎁 *NEW NFT GIFT ALERT\!* 🎁\n\n"
-            f"**Item:** `{item_name}`\n"
-            f"**Time:** `{timestamp_readable}`\n"
-            f"**Source:** `{transfer.get('sender', {}).get('address', 'N/A')[:8]}...`\n"
-            f"**Destination:** `{transfer.get('recipient', {}).get('address', 'N/A')[:8]}...`\n"
-            f"**Link:** [View Gift]({link})\n"
-            f"_Check the link for full details, price, and marketplace\._"
+        message = ALERT_TEMPLATE % (
+            item_name,
+            timestamp_readable,
+            escape_markdown(transfer.get('sender', {}).get('address', 'N/A')[:8]),
+            escape_markdown(transfer.get('recipient', {}).get('address', 'N/A')[:8]),
+            link,
         )
-        
+        alerts.append(message)
+
+    # Batch all alerts into as few Telegram messages as possible
+    for message in split_message(alerts):
         send_alert(message)
-        
+
     # --- 4. STATE UPDATE ---
     
-    if new_events_found and newest_timestamp > last_timestamp:
+    if new_events_found:
         write_last_timestamp(newest_timestamp)
-        print(f"State updated to new timestamp: {newest_timestamp}")
-    elif not new_events_found:
-        print("No new gifts found since the last check.")
+        write_seen_transfers(seen_keys + [transfer_key(t) for t in transfers])
+        logging.info("State updated to new timestamp: %s", newest_timestamp)
+    else:
+        logging.info("No new gifts found since the last check.")
+
+    etag = response.headers.get('ETag')
+    if etag:
+        write_last_etag(etag)
 
 
 if __name__ == '__main__':